@@ -30,6 +30,8 @@ def get_parser():
                         help='Whether to fill the crater masks or not')
     parser.add_argument('--mask_thickness', type=int, default=const.MASK_THICKNESS,
                         help='How thick to make the mask rim if not filled')
+    parser.add_argument('--uint8_images', action='store_true',
+                        help='Store images as 8-bit integers instead of 32-bit floats')
 
     return parser
 
@@ -53,7 +55,8 @@ if __name__ == "__main__":
         n_validation=args.n_val,
         n_testing=args.n_test,
         identifier=args.identifier,
-        generation_kwargs=generation_kwargs
+        generation_kwargs=generation_kwargs,
+        uint8_images=args.uint8_images
     )
 
 
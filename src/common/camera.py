@@ -3,10 +3,9 @@ from typing import Tuple
 
 import numpy as np
 import numpy.linalg as LA
-from astropy.coordinates import spherical_to_cartesian
 
 import src.common.constants as const
-from src.common.coordinates import OrbitingBodyBase
+from src.common.coordinates import OrbitingBodyBase, spherical_to_cartesian
 
 
 def camera_matrix(fov=const.CAMERA_FOV, resolution=const.CAMERA_RESOLUTION, alpha=0):
@@ -31,19 +30,17 @@ def camera_matrix(fov=const.CAMERA_FOV, resolution=const.CAMERA_RESOLUTION, alph
     .. [1] https://www.cs.ucf.edu/~mtappen/cap5415/lecs/lec19.pdf
     """
 
-    if isinstance(resolution, Iterable):
-        x_0, y_0 = map(lambda num: num / 2, resolution)
-    else:
-        x_0 = y_0 = resolution / 2
+    fov = np.broadcast_to(np.asarray(fov, dtype=np.float64), (2,))
+    offset = np.broadcast_to(np.asarray(resolution, dtype=np.float64), (2,)) / 2
+    f = offset / np.tan(np.radians(fov / 2))
 
-    if isinstance(fov, Iterable):
-        f_x, f_y = map(lambda num, fov_: num / np.tan(np.radians(fov_ / 2)), (x_0, y_0), fov)
-    else:
-        f_x, f_y = map(lambda num: num / np.tan(np.radians(fov / 2)), (x_0, y_0))
+    K = np.zeros((3, 3))
+    K[[0, 1], [0, 1]] = f
+    K[0, 1] = alpha
+    K[:2, 2] = offset
+    K[2, 2] = 1
 
-    return np.array([[f_x, alpha, x_0],
-                     [0, f_y, y_0],
-                     [0, 0, 1]])
+    return K
 
 
 def projection_matrix(K, T_CM, r_M):
@@ -86,6 +83,8 @@ class Camera(OrbitingBodyBase):
         super().__init__(**kwargs)
         self.__fov = None
         self.__resolution = None
+        self.__camera_matrix = None
+        self.__projection_matrix = None
 
         self.fov = fov
         self.resolution = resolution
@@ -126,6 +125,9 @@ class Camera(OrbitingBodyBase):
         else:
             self.__fov = tuple(fov)
 
+        self.__camera_matrix = None
+        self.__projection_matrix = None
+
     @property
     def resolution(self) -> Tuple:
         return self.__resolution
@@ -145,16 +147,42 @@ class Camera(OrbitingBodyBase):
         else:
             self.__resolution = tuple(resolution)
 
+        self.__camera_matrix = None
+        self.__projection_matrix = None
+
+    @OrbitingBodyBase.position.setter
+    def position(self, position):
+        OrbitingBodyBase.position.fset(self, position)
+        self.__projection_matrix = None
+
+    @OrbitingBodyBase.attitude.setter
+    def attitude(self, attitude):
+        OrbitingBodyBase.attitude.fset(self, attitude)
+        self.__projection_matrix = None
+
+    # Aliases
+    r: np.ndarray = position
+    T: np.ndarray = attitude
+
     @property
     def camera_matrix(self) -> np.ndarray:
-        return camera_matrix(fov=self.fov, resolution=self.resolution)
+        """Camera matrix, cached until fov or resolution is reassigned. Returned array is read-only."""
+        if self.__camera_matrix is None:
+            self.__camera_matrix = camera_matrix(fov=self.fov, resolution=self.resolution)
+            self.__camera_matrix.setflags(write=False)
+        return self.__camera_matrix
 
     # Alias
     K: np.ndarray = camera_matrix
 
     @property
     def projection_matrix(self) -> np.ndarray:
-        return projection_matrix(K=self.K, T_CM=self.attitude, r_M=self.position)
+        """Projection matrix, cached until the camera matrix, position or attitude is reassigned. Returned array is
+        read-only."""
+        if self.__projection_matrix is None:
+            self.__projection_matrix = projection_matrix(K=self.K, T_CM=self.attitude, r_M=self.position)
+            self.__projection_matrix.setflags(write=False)
+        return self.__projection_matrix
 
     # Alias
     P: np.ndarray = projection_matrix
@@ -4,20 +4,20 @@ import cv2
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
-from astropy.coordinates import spherical_to_cartesian
 from matplotlib.collections import EllipseCollection
-from numba import njit
+from numba import njit, prange
 from numpy import linalg as LA
 from scipy.spatial.distance import cdist
 
 import src.common.constants as const
 from src.common.camera import camera_matrix, projection_matrix, Camera
-from src.common.coordinates import ENU_system
+from src.common.coordinates import ENU_system, spherical_to_cartesian
 from src.common.robbins import load_craters, extract_robbins_dataset
 
 
 def matrix_adjugate(matrix):
-    """Return adjugate matrix [1].
+    """Return adjugate matrix [1]. For (batches of) 3x3 matrices the cofactors are expanded in closed form, which
+    avoids a LAPACK inversion and also holds for singular matrices.
 
     Parameters
     ----------
@@ -33,9 +33,26 @@ def matrix_adjugate(matrix):
     ----------
     .. [1] https://en.wikipedia.org/wiki/Adjugate_matrix
     """
+    if matrix.shape[-2:] != (3, 3):
+        cofactor = LA.inv(matrix).T * LA.det(matrix)
+        return cofactor.T
 
-    cofactor = LA.inv(matrix).T * LA.det(matrix)
-    return cofactor.T
+    a, b, c = matrix[..., 0, 0], matrix[..., 0, 1], matrix[..., 0, 2]
+    d, e, f = matrix[..., 1, 0], matrix[..., 1, 1], matrix[..., 1, 2]
+    g, h, i = matrix[..., 2, 0], matrix[..., 2, 1], matrix[..., 2, 2]
+
+    adj = np.empty_like(matrix)
+    adj[..., 0, 0] = e * i - f * h
+    adj[..., 0, 1] = c * h - b * i
+    adj[..., 0, 2] = b * f - c * e
+    adj[..., 1, 0] = f * g - d * i
+    adj[..., 1, 1] = a * i - c * g
+    adj[..., 1, 2] = c * d - a * f
+    adj[..., 2, 0] = d * h - e * g
+    adj[..., 2, 1] = b * g - a * h
+    adj[..., 2, 2] = a * e - b * d
+
+    return adj
 
 
 def scale_det(matrix):
@@ -90,22 +107,26 @@ def conic_matrix(a, b, psi, x=0, y=0):
     else:
         raise TypeError("Input must be of type torch.Tensor, np.ndarray, int or float.")
 
-    A = (a ** 2) * pkg.sin(psi) ** 2 + (b ** 2) * pkg.cos(psi) ** 2
-    B = 2 * ((b ** 2) - (a ** 2)) * pkg.cos(psi) * pkg.sin(psi)
-    C = (a ** 2) * pkg.cos(psi) ** 2 + b ** 2 * pkg.sin(psi) ** 2
+    sin_psi, cos_psi = pkg.sin(psi), pkg.cos(psi)
+    sin_sq, cos_sq = sin_psi ** 2, cos_psi ** 2
+    a_sq, b_sq = a ** 2, b ** 2
+
+    A = a_sq * sin_sq + b_sq * cos_sq
+    B = 2 * (b_sq - a_sq) * cos_psi * sin_psi
+    C = a_sq * cos_sq + b_sq * sin_sq
     D = -2 * A * x - B * y
     F = -B * x - 2 * C * y
-    G = A * (x ** 2) + B * x * y + C * (y ** 2) - (a ** 2) * (b ** 2)
+    G = A * (x ** 2) + B * x * y + C * (y ** 2) - a_sq * b_sq
 
-    out[:, 0, 0] = A
-    out[:, 1, 1] = C
-    out[:, 2, 2] = G
+    out[..., 0, 0] = A
+    out[..., 1, 1] = C
+    out[..., 2, 2] = G
 
-    out[:, 1, 0] = out[:, 0, 1] = B / 2
+    out[..., 1, 0] = out[..., 0, 1] = B / 2
 
-    out[:, 2, 0] = out[:, 0, 2] = D / 2
+    out[..., 2, 0] = out[..., 0, 2] = D / 2
 
-    out[:, 2, 1] = out[:, 1, 2] = F / 2
+    out[..., 2, 1] = out[..., 1, 2] = F / 2
 
     return out
 
@@ -226,12 +247,109 @@ def crater_camera_homography(r_craters, P_MC):
     -------
         (Nx)3x3 homography matrix
     """
-    S = np.concatenate((np.identity(2), np.zeros((1, 2))), axis=0)
-    k = np.array([0, 0, 1])[:, None]
+    e_i, n_i, _ = ENU_system(r_craters)
+
+    # Fill [[T_EM @ S, r], [k^T]] in place; T_EM @ S selects the East & North columns of the ENU basis
+    H_Mi = np.empty((len(r_craters), 4, 3))
+    H_Mi[:, :3, :1] = e_i
+    H_Mi[:, :3, 1:2] = n_i
+    H_Mi[:, :3, 2:] = r_craters
+    H_Mi[:, 3] = (0, 0, 1)
+
+    return P_MC @ H_Mi
 
-    H_Mi = np.concatenate((np.concatenate(ENU_system(r_craters), axis=-1) @ S, r_craters), axis=-1)
 
-    return P_MC @ np.concatenate((H_Mi, np.tile(k.T[None, ...], (len(H_Mi), 1, 1))), axis=1)
+def project_conics(C_craters, H_Ci):
+    """Transform conics through homography according to:
+
+    .. math:: \mathbf{A}_i = \mathbf{H}_{C_i}^{-T} \mathbf{C}_i \mathbf{H}_{C_i}^{-1}
+
+    The batched 3x3 inverse is formed from the closed-form adjugate and determinant instead of a LAPACK call.
+
+    Parameters
+    ----------
+    C_craters : np.ndarray
+        Nx3x3 array of crater conics
+    H_Ci : np.ndarray
+        Nx3x3 homography matrices
+
+    Returns
+    -------
+    np.ndarray
+        Nx3x3 array of projected conics
+    """
+    H_adj = matrix_adjugate(H_Ci)
+    det = np.einsum('...j,...j->...', H_Ci[..., 0, :], H_adj[..., :, 0])
+    H_inv = H_adj / det[..., None, None]
+    return H_inv.transpose((0, 2, 1)) @ C_craters @ H_inv
+
+
+@njit(parallel=True, cache=True)
+def _project_crater_conics_kernel(C_craters, r_craters, P_MC, out):
+    """Per-crater fused version of crater_camera_homography followed by project_conics.
+
+    Parameters
+    ----------
+    C_craters : np.ndarray
+        Nx3x3 array of crater conics
+    r_craters : np.ndarray
+        Nx3 (C-contiguous) position vector of craters.
+    P_MC : np.ndarray
+        3x4 projection matrix from selenographic frame to camera pixel frame.
+    out : np.ndarray
+        Nx3x3 output buffer for the projected conics
+    """
+    for n in prange(len(r_craters)):
+        x, y, z = r_craters[n, 0], r_craters[n, 1], r_craters[n, 2]
+
+        # ENU system: e = k x r, n = r x e (normalized)
+        norm_e = np.sqrt(x * x + y * y)
+        e_x, e_y = -y / norm_e, x / norm_e
+        n_x, n_y, n_z = -z * e_y, z * e_x, x * e_y - y * e_x
+        norm_n = np.sqrt(n_x * n_x + n_y * n_y + n_z * n_z)
+        n_x, n_y, n_z = n_x / norm_n, n_y / norm_n, n_z / norm_n
+
+        # H_Ci = P_MC @ [[e, n, r], [0, 0, 1]]
+        H = np.empty((3, 3))
+        for row in range(3):
+            H[row, 0] = P_MC[row, 0] * e_x + P_MC[row, 1] * e_y
+            H[row, 1] = P_MC[row, 0] * n_x + P_MC[row, 1] * n_y + P_MC[row, 2] * n_z
+            H[row, 2] = P_MC[row, 0] * x + P_MC[row, 1] * y + P_MC[row, 2] * z + P_MC[row, 3]
+
+        # Closed-form inverse (adjugate / determinant)
+        H_inv = np.empty((3, 3))
+        H_inv[0, 0] = H[1, 1] * H[2, 2] - H[1, 2] * H[2, 1]
+        H_inv[0, 1] = H[0, 2] * H[2, 1] - H[0, 1] * H[2, 2]
+        H_inv[0, 2] = H[0, 1] * H[1, 2] - H[0, 2] * H[1, 1]
+        H_inv[1, 0] = H[1, 2] * H[2, 0] - H[1, 0] * H[2, 2]
+        H_inv[1, 1] = H[0, 0] * H[2, 2] - H[0, 2] * H[2, 0]
+        H_inv[1, 2] = H[0, 2] * H[1, 0] - H[0, 0] * H[1, 2]
+        H_inv[2, 0] = H[1, 0] * H[2, 1] - H[1, 1] * H[2, 0]
+        H_inv[2, 1] = H[0, 1] * H[2, 0] - H[0, 0] * H[2, 1]
+        H_inv[2, 2] = H[0, 0] * H[1, 1] - H[0, 1] * H[1, 0]
+        det = H[0, 0] * H_inv[0, 0] + H[0, 1] * H_inv[1, 0] + H[0, 2] * H_inv[2, 0]
+        for i in range(3):
+            for j in range(3):
+                H_inv[i, j] /= det
+
+        # A = H^-T @ C @ H^-1
+        for i in range(3):
+            for j in range(3):
+                acc = 0.
+                for k in range(3):
+                    for m in range(3):
+                        acc += H_inv[k, i] * C_craters[n, k, m] * H_inv[m, j]
+                out[n, i, j] = acc
+
+    return out
+
+
+def _project_crater_conics(C_craters, r_craters, P_MC):
+    out = np.empty((len(C_craters), 3, 3))
+    return _project_crater_conics_kernel(np.ascontiguousarray(C_craters, dtype=np.float64),
+                                         np.ascontiguousarray(r_craters.reshape(-1, 3), dtype=np.float64),
+                                         np.ascontiguousarray(P_MC, dtype=np.float64),
+                                         out)
 
 
 def project_crater_conics(C_craters, r_craters, fov, resolution, T_CM, r_M):
@@ -264,8 +382,7 @@ def project_crater_conics(C_craters, r_craters, fov, resolution, T_CM, r_M):
 
     K = camera_matrix(fov, resolution)
     P_MC = projection_matrix(K, T_CM, r_M)
-    H_Ci = crater_camera_homography(r_craters, P_MC)
-    return LA.inv(H_Ci).transpose((0, 2, 1)) @ C_craters @ LA.inv(H_Ci)
+    return _project_crater_conics(C_craters, r_craters, P_MC)
 
 
 def project_crater_centers(r_craters, fov, resolution, T_CM, r_M):
@@ -298,8 +415,7 @@ def project_crater_centers(r_craters, fov, resolution, T_CM, r_M):
 
 class ConicProjector(Camera):
     def project_crater_conics(self, C_craters, r_craters):
-        H_Ci = crater_camera_homography(r_craters, self.projection_matrix)
-        return LA.inv(H_Ci).transpose((0, 2, 1)) @ C_craters @ LA.inv(H_Ci)
+        return _project_crater_conics(C_craters, r_craters, self.projection_matrix)
 
     def project_crater_centers(self, r_craters):
         H_Ci = crater_camera_homography(r_craters, self.projection_matrix)
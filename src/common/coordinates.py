@@ -2,12 +2,49 @@ from typing import Union
 
 import numpy as np
 import numpy.linalg as LA
-from astropy.coordinates import spherical_to_cartesian, cartesian_to_spherical
 from scipy.spatial.transform import Rotation
 
 import src.common.constants as const
 
 
+def spherical_to_cartesian(r, lat, long):
+    """Convert spherical coordinates to Cartesian coordinates.
+
+    Parameters
+    ----------
+    r : float, np.ndarray
+        Radial distance
+    lat : float, np.ndarray
+        Latitude (radians)
+    long : float, np.ndarray
+        Longitude (radians)
+
+    Returns
+    -------
+    x, y, z : float, np.ndarray
+        Cartesian coordinates
+    """
+    cos_lat = np.cos(lat)
+    return r * cos_lat * np.cos(long), r * cos_lat * np.sin(long), r * np.sin(lat)
+
+
+def cartesian_to_spherical(x, y, z):
+    """Convert Cartesian coordinates to spherical coordinates.
+
+    Parameters
+    ----------
+    x, y, z : float, np.ndarray
+        Cartesian coordinates
+
+    Returns
+    -------
+    r, lat, long : float, np.ndarray
+        Radial distance, latitude (radians) and longitude (radians, wrapped to [0, 2pi))
+    """
+    r_xy = np.hypot(x, y)
+    return np.hypot(r_xy, z), np.arctan2(z, r_xy), np.arctan2(y, x) % (2 * np.pi)
+
+
 def ENU_system(r):
     """Return local East-North-Up (ENU) coordinate system for point defined by p.
 
@@ -232,7 +269,7 @@ class OrbitingBodyBase:
 
     @property
     def coordinates(self):
-        return tuple(map(lambda x: x.value.item(), cartesian_to_spherical(*self.position)))
+        return tuple(map(lambda x: x.item(), cartesian_to_spherical(*self.position)))
 
     @property
     def latitude(self):
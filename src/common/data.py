@@ -97,7 +97,8 @@ def make_dataset(n_training,
                  n_testing,
                  output_path=None,
                  identifier=None,
-                 generation_kwargs=None):
+                 generation_kwargs=None,
+                 uint8_images=False):
     if output_path is None:
         if identifier is not None:
             output_path = f"data/dataset_{identifier}.h5"
@@ -126,9 +127,16 @@ def make_dataset(n_training,
 
             (images, masks, position, attitude, date, sol_incidence, A_craters) = generate(dset_size,
                                                                                            **generation_kwargs_)
+            if uint8_images:
+                images = np.round(np.clip(images, 0, 1) * 255).astype(np.uint8)
+
+            # One chunk per sample, matching the per-index reads done during training
+            group.create_dataset("images", data=images, chunks=(1, *images.shape[1:]))
+            group.create_dataset("masks", data=masks, chunks=(1, *masks.shape[1:]))
+
             for ds, name in zip(
-                    (images, masks, position, attitude, date, sol_incidence),
-                    ("images", "masks", "position", "attitude", "date", "sol_incidence")
+                    (position, attitude, date, sol_incidence),
+                    ("position", "attitude", "date", "sol_incidence")
                 ):
                 group.create_dataset(name, data=ds)
 
@@ -146,6 +154,8 @@ def inspect_dataset(dataset_path, plot=True, summary=True, n_inspect=25, pixel_r
         idx = np.random.choice(np.arange(len(hf['training/images'])), n_inspect)
         idx = np.sort(idx)
         images = hf['training/images'][idx]
+        if images.dtype == np.uint8:
+            images = images / 255.
         masks = hf['training/masks'][idx]
         header = hf["header"]
         header_dict = dict()
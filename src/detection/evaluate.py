@@ -1,14 +1,14 @@
 import numpy as np
 import torch
-from astropy.coordinates import cartesian_to_spherical
 from matplotlib import pyplot as plt
 from torch.utils.data import DataLoader
 from tqdm.auto import tqdm as tq
 
 from common import constants as const
 from common.conics import plot_conics, conic_center
+from common.coordinates import cartesian_to_spherical
 from detection.metrics import detection_metrics, get_matched_idxs, gaussian_angle_distance
-from detection.training import CraterEllipseDataset, collate_fn
+from detection.training import CraterEllipseDataset, collate_fn, image_to_float
 from src import CraterDetector
 
 
@@ -43,7 +43,7 @@ class Evaluator:
         for row in range(n_rows):
             for col in range(n_cols):
                 images, targets = next(iter(loader))
-                images = list(image.to(self.device) for image in images)
+                images = list(image_to_float(image.to(self.device)) for image in images)
                 targets = [{k: v.to(self.device) for k, v in t.items()} for t in targets]
 
                 pred = self._model(images)
@@ -67,14 +67,14 @@ class Evaluator:
                 m1, m2 = map(lambda arr: torch.vstack(tuple(conic_center(arr).T)).T[..., None],
                              (A_matched[matched], A_pred[matched]))
 
-                lat = np.degrees(lat.value)[0]
-                long = np.degrees(long.value)[0]
+                lat = np.degrees(lat)[0]
+                long = np.degrees(long)[0]
                 long -= 360 if long > 180 else 0
 
                 textstr = '\n'.join((
                     rf'$\varphi={lat:.1f}^o$',
                     rf'$\lambda={long:.1f}^o$',
-                    rf'$h={r.value[0] - const.RMOON:.0f}$ km',
+                    rf'$h={r[0] - const.RMOON:.0f}$ km',
                 ))
 
                 axes[row, col].imshow(images[0][0].cpu().numpy(), cmap='gray')
@@ -122,7 +122,7 @@ class Evaluator:
         dist = torch.zeros((len(loader), loader.batch_size, len(confidence_thresholds)), device=self.device)
 
         for batch, (images, targets_all) in enumerate(bar):
-            images = list(image.to(self.device) for image in images)
+            images = list(image_to_float(image.to(self.device)) for image in images)
             targets_all = [{k: v.to(self.device) for k, v in t.items()} for t in targets_all]
 
             pred_all = self._model(images)
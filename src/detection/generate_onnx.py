@@ -2,7 +2,7 @@ import torch
 from torch.utils.data import DataLoader
 import onnx
 
-from detection.training import CraterEllipseDataset, collate_fn
+from detection.training import CraterEllipseDataset, collate_fn, image_to_float
 from src import CraterDetector
 
 if __name__ == "__main__":
@@ -16,6 +16,7 @@ if __name__ == "__main__":
     loader = DataLoader(ds, batch_size=1, shuffle=True, num_workers=0, collate_fn=collate_fn)
 
     images, targets = next(iter(loader))
+    images = list(image_to_float(image.to(device)) for image in images)
 
     out = model(images)
     print(out[0].keys())
@@ -2,7 +2,7 @@ import math
 import os
 import time
 from statistics import mean
-from typing import Tuple, Dict, Iterable
+from typing import Tuple, Dict, Iterable, List
 
 import h5py
 import mlflow
@@ -28,26 +28,78 @@ class CraterDataset(Dataset):
                  ):
         self.file_path = file_path
         self.group = group
+        self._dataset = None
 
-    def __getitem__(self, idx: ...) -> Tuple[torch.Tensor, torch.Tensor]:
-        with h5py.File(self.file_path, 'r') as dataset:
+        with h5py.File(self.file_path, 'r') as f:
+            self._len = len(f[self.group]['images'])
+
+    @property
+    def dataset(self) -> h5py.File:
+        """Read-only HDF5 handle, opened lazily so every DataLoader worker holds its own file descriptor."""
+        if self._dataset is None:
+            self._dataset = h5py.File(self.file_path, 'r')
+        return self._dataset
 
-            image = dataset[self.group]["images"][idx]
-            masks = dataset[self.group]["masks"][idx]
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_dataset'] = None
+        return state
+
+    def __getitem__(self, idx: ...) -> Tuple[torch.Tensor, torch.Tensor]:
+        image = self.dataset[self.group]["images"][idx]
+        masks = self.dataset[self.group]["masks"][idx]
 
-            image = torch.as_tensor(image)
-            masks = torch.as_tensor(masks, dtype=torch.float32)
+        image = torch.as_tensor(image)
+        masks = torch.as_tensor(masks, dtype=torch.float32)
 
-            return image, masks
+        return image, masks
 
     def random(self):
         return self.__getitem__(
-            np.random.randint(0, len(self))
+            np.random.randint(0, self._len)
         )
 
+    def random_batch(self, n: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Sample n random images and masks using a single read per HDF5 dataset.
+
+        h5py only supports fancy indexing with increasing, unique indices, so the samples are read in sorted order
+        and permuted back to their random order afterwards.
+
+        Parameters
+        ----------
+        n : int
+            Number of samples to draw (with replacement).
+
+        Returns
+        -------
+        images, masks : torch.Tensor
+        """
+        idx = np.random.randint(0, self._len, size=n)
+        unique_idx, inverse = np.unique(idx, return_inverse=True)
+
+        images = self.dataset[self.group]["images"][unique_idx][inverse]
+        masks = self.dataset[self.group]["masks"][unique_idx][inverse]
+
+        return torch.as_tensor(images), torch.as_tensor(masks, dtype=torch.float32)
+
     def __len__(self):
-        with h5py.File(self.file_path, 'r') as f:
-            return len(f[self.group]['images'])
+        return self._len
+
+
+def image_to_float(image: torch.Tensor) -> torch.Tensor:
+    """Rescale images stored as uint8 to float32 in [0, 1], preferably after transfer to the training device. Float
+    images are returned unchanged.
+    """
+    if image.dtype == torch.uint8:
+        return image.float().mul_(1. / 255.)
+    return image
+
+
+def worker_init_fn(worker_id: int):
+    """Give each DataLoader worker a fresh HDF5 handle, since h5py file objects cannot be shared across processes.
+    """
+    worker_dataset = torch.utils.data.get_worker_info().dataset
+    worker_dataset._dataset = h5py.File(worker_dataset.file_path, 'r')
 
 
 def collate_fn(batch: Iterable):
@@ -63,9 +115,8 @@ class CraterMaskDataset(CraterDataset):
     def __getitem__(self, idx: ...) -> Tuple[torch.Tensor, Dict]:
         image, mask = super(CraterMaskDataset, self).__getitem__(idx)
 
-        with h5py.File(self.file_path, 'r') as dataset:
-            position = torch.as_tensor(dataset[self.group]["position"][idx], dtype=torch.float64)
-            attitude = torch.as_tensor(dataset[self.group]["attitude"][idx], dtype=torch.float64)
+        position = torch.as_tensor(self.dataset[self.group]["position"][idx], dtype=torch.float64)
+        attitude = torch.as_tensor(self.dataset[self.group]["attitude"][idx], dtype=torch.float64)
 
         mask: torch.Tensor = mask.int()
 
@@ -132,10 +183,8 @@ class CraterEllipseDataset(CraterMaskDataset):
         image, target = super(CraterEllipseDataset, self).__getitem__(idx)
         target.pop("masks")
 
-        with h5py.File(self.file_path, 'r') as dataset:
-            start_idx = dataset[self.group]["craters/crater_list_idx"][idx]
-            end_idx = dataset[self.group]["craters/crater_list_idx"][idx + 1]
-            A_craters = dataset[self.group]["craters/A_craters"][start_idx:end_idx]
+        start_idx, end_idx = self.dataset[self.group]["craters/crater_list_idx"][idx:idx + 2]
+        A_craters = self.dataset[self.group]["craters/A_craters"][start_idx:end_idx]
 
         boxes = target["boxes"]
 
@@ -155,15 +204,43 @@ class CraterEllipseDataset(CraterMaskDataset):
         return image, target
 
 
-def get_dataloaders(dataset_path: str, batch_size: int = 10, num_workers: int = 2) -> \
+def log_batch_losses(pending: List[Tuple[int, Dict[str, torch.Tensor]]], metrics: Dict[str, List], bar: tq,
+                     stage: str) -> None:
+    """Copy buffered per-batch losses to the host in a single transfer, record them in `metrics` and update the
+    progress bar. Clears `pending` afterwards.
+    """
+    if len(pending) == 0:
+        return
+
+    batches, loss_dicts = zip(*pending)
+    keys = list(loss_dicts[0].keys())
+    values = torch.stack([torch.stack([d[k] for k in keys]) for d in loss_dicts]).tolist()
+    pending.clear()
+
+    for batch, row in zip(batches, values):
+        postfix = dict(zip(keys, row))
+
+        if not math.isfinite(postfix["loss_total"]):
+            raise RuntimeError(f"Loss is {postfix['loss_total']}, stopping {stage}")
+
+        metrics["batch"].append(batch)
+        for k, v in postfix.items():
+            metrics[k].append(v)
+
+    bar.set_postfix(ordered_dict=postfix)
+
+
+def get_dataloaders(dataset_path: str, batch_size: int = 10, num_workers: int = 2, pin_memory: bool = False) -> \
         Tuple[DataLoader, DataLoader, DataLoader]:
+    loader_kwargs = dict(num_workers=num_workers, collate_fn=collate_fn, pin_memory=pin_memory)
+    if num_workers > 0:
+        loader_kwargs.update(worker_init_fn=worker_init_fn, persistent_workers=True, prefetch_factor=4)
+
     train_dataset = CraterEllipseDataset(file_path=dataset_path, group="training")
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, num_workers=num_workers, collate_fn=collate_fn,
-                              shuffle=True)
+    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, **loader_kwargs)
 
     validation_dataset = CraterEllipseDataset(file_path=dataset_path, group="validation")
-    validation_loader = DataLoader(validation_dataset, batch_size=batch_size, num_workers=num_workers,
-                                   collate_fn=collate_fn, shuffle=True)
+    validation_loader = DataLoader(validation_dataset, batch_size=batch_size, shuffle=True, **loader_kwargs)
 
     test_dataset = CraterEllipseDataset(file_path=dataset_path, group="test")
     test_loader = DataLoader(test_dataset, batch_size=1, num_workers=0, collate_fn=collate_fn,
@@ -174,7 +251,8 @@ def get_dataloaders(dataset_path: str, batch_size: int = 10, num_workers: int =
 
 def train_model(model: nn.Module, num_epochs: int, dataset_path: str, initial_lr=1e-2, run_id: str = None,
                 scheduler=None, batch_size: int = 32, momentum: float = 0.9, weight_decay: float = 0.0005,
-                num_workers: int = 4, device=None) -> None:
+                num_workers: int = 4, device=None, amp: bool = False, compile_model: bool = False,
+                log_interval: int = 20) -> None:
 
     pretrained = run_id is not None
 
@@ -187,11 +265,23 @@ def train_model(model: nn.Module, num_epochs: int, dataset_path: str, initial_lr
     if isinstance(device, str):
         device = torch.device(device)
 
+    model.to(device)
+    if device.type == 'cuda':
+        # NHWC weights make cuDNN select native channels-last (Tensor Core) convolution kernels
+        model.to(memory_format=torch.channels_last)
+
+        # Backbone input size is fixed by the dataset, so autotuned convolution algorithms are benchmarked only once
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+
+    # The compiled wrapper shares parameters with `model`; state dicts and inference keep using the original module
+    forward_model = torch.compile(model) if compile_model else model
+
     if pretrained:
         checkpoint = mlflow.pytorch.load_state_dict(f"runs:/{run_id}/checkpoint")
 
         model.load_state_dict(checkpoint['model_state_dict'])
-        model.to(device)
 
         params = [p for p in model.parameters() if p.requires_grad]
         optimizer = SGD(params, lr=initial_lr, momentum=momentum, weight_decay=weight_decay)
@@ -199,13 +289,16 @@ def train_model(model: nn.Module, num_epochs: int, dataset_path: str, initial_lr
         if scheduler is None:
             scheduler = ReduceLROnPlateau(optimizer, patience=5, cooldown=2)
         scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
+        scaler = torch.cuda.amp.GradScaler(enabled=amp)
+        if amp and 'scaler_state_dict' in checkpoint:
+            scaler.load_state_dict(checkpoint['scaler_state_dict'])
     else:
         checkpoint = dict()
-        model.to(device)
         params = [p for p in model.parameters() if p.requires_grad]
         optimizer = SGD(params, lr=initial_lr, momentum=momentum, weight_decay=weight_decay)
         if scheduler is None:
             scheduler = ReduceLROnPlateau(optimizer, patience=5, cooldown=2)
+        scaler = torch.cuda.amp.GradScaler(enabled=amp)
 
     tracked_params = ('momentum', 'weight_decay', 'dampening')
 
@@ -253,8 +346,10 @@ def train_model(model: nn.Module, num_epochs: int, dataset_path: str, initial_lr
                     pass
             mlflow.log_figure(inspect_dataset(dataset_path, return_fig=True, summary=False), f"dataset_inspection.png")
 
+        train_loader, validation_loader, test_loader = get_dataloaders(dataset_path, batch_size, num_workers,
+                                                                       pin_memory=device.type == 'cuda')
+
         for e in range(start_e, num_epochs + start_e):
-            train_loader, validation_loader, test_loader = get_dataloaders(dataset_path, batch_size, num_workers)
 
             print(f'\n-----Epoch {e} started-----\n')
 
@@ -272,31 +367,28 @@ def train_model(model: nn.Module, num_epochs: int, dataset_path: str, initial_lr
                          "loss_objectness": 0.,
                          "loss_rpn_box_reg": 0
                      })
+            # Losses stay on the device and are synchronised every `log_interval` batches instead of every batch
+            pending_losses = []
             for batch, (images, targets) in enumerate(bar, 1):
-                images = list(image.to(device) for image in images)
-                targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
-
-                loss_dict = model(images, targets)
-
-                loss = sum(l for l in loss_dict.values())
+                images = list(image_to_float(image.to(device, non_blocking=True)) for image in images)
+                targets = [{k: v.to(device, non_blocking=True) for k, v in t.items()} for t in targets]
 
-                if not math.isfinite(loss):
-                    del images, targets
-                    raise RuntimeError(f"Loss is {loss}, stopping training")
+                with torch.cuda.amp.autocast(enabled=amp):
+                    loss_dict = forward_model(images, targets)
 
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
+                    loss = sum(l for l in loss_dict.values())
 
-                postfix = dict(loss_total=loss.item())
-                run_metrics["train"]["loss_total"].append(loss.item())
-                run_metrics["train"]["batch"].append(batch)
+                optimizer.zero_grad(set_to_none=True)
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
 
-                for k, v in loss_dict.items():
-                    postfix[k] = v.item()
-                    run_metrics["train"][k].append(v.item())
+                loss_dict = dict(loss_total=loss, **loss_dict)
+                pending_losses.append((batch, {k: v.detach().float() for k, v in loss_dict.items()}))
+                if batch % log_interval == 0:
+                    log_batch_losses(pending_losses, run_metrics["train"], bar, "training")
 
-                bar.set_postfix(ordered_dict=postfix)
+            log_batch_losses(pending_losses, run_metrics["train"], bar, "training")
 
             with torch.no_grad():
                 bar = tq(validation_loader, desc=f"Validation [{e}]",
@@ -308,27 +400,22 @@ def train_model(model: nn.Module, num_epochs: int, dataset_path: str, initial_lr
                              "loss_objectness": 0.,
                              "loss_rpn_box_reg": 0
                          })
+                pending_losses = []
                 for batch, (images, targets) in enumerate(bar, 1):
-                    images = list(image.to(device) for image in images)
-                    targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
-
-                    loss_dict = model(images, targets)
-
-                    loss = sum(l for l in loss_dict.values())
+                    images = list(image_to_float(image.to(device, non_blocking=True)) for image in images)
+                    targets = [{k: v.to(device, non_blocking=True) for k, v in t.items()} for t in targets]
 
-                    if not math.isfinite(loss):
-                        del images, targets
-                        raise RuntimeError(f"Loss is {loss}, stopping validation")
+                    with torch.cuda.amp.autocast(enabled=amp):
+                        loss_dict = forward_model(images, targets)
 
-                    postfix = dict(loss_total=loss.item())
-                    run_metrics["valid"]["loss_total"].append(loss.item())
-                    run_metrics["valid"]["batch"].append(batch)
+                        loss = sum(l for l in loss_dict.values())
 
-                    for k, v in loss_dict.items():
-                        postfix[k] = v.item()
-                        run_metrics["valid"][k].append(v.item())
+                    loss_dict = dict(loss_total=loss, **loss_dict)
+                    pending_losses.append((batch, {k: v.float() for k, v in loss_dict.items()}))
+                    if batch % log_interval == 0:
+                        log_batch_losses(pending_losses, run_metrics["valid"], bar, "validation")
 
-                    bar.set_postfix(ordered_dict=postfix)
+                log_batch_losses(pending_losses, run_metrics["valid"], bar, "validation")
 
             time_elapsed = time.time() - since
 
@@ -351,13 +438,14 @@ def train_model(model: nn.Module, num_epochs: int, dataset_path: str, initial_lr
                 'model_state_dict': model.state_dict(),
                 'optimizer_state_dict': optimizer.state_dict(),
                 'scheduler_state_dict': scheduler.state_dict(),
+                'scaler_state_dict': scaler.state_dict(),
                 'run_metrics': run_metrics
             }
 
             mlflow.pytorch.log_state_dict(state_dict, artifact_path="checkpoint")
 
             images, targets = next(iter(test_loader))
-            images = list(image.to(device) for image in images)
+            images = list(image_to_float(image.to(device)) for image in images)
             targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
             model.eval()
 
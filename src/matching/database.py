@@ -5,19 +5,18 @@ import numpy as np
 import numpy.linalg as LA
 import pandas as pd
 import torch
-from astropy.coordinates import spherical_to_cartesian
 from scipy.spatial import KDTree
 from sklearn.neighbors import radius_neighbors_graph
 
 import src.common.constants as const
-from src.common.conics import crater_camera_homography
+from src.common.conics import crater_camera_homography, project_conics
 from src.common.robbins import load_craters
 from src.common.camera import camera_matrix
 from src.common.conics import conic_matrix, conic_center
-from src.common.coordinates import nadir_attitude
+from src.common.coordinates import nadir_attitude, spherical_to_cartesian
 from src.matching.position_estimation import PositionRegressor
 from src.matching.projective_invariants import CoplanarInvariants
-from src.matching.utils import get_cliques_by_length, shift_nd
+from src.matching.utils import get_cliques_by_length, shift_nd, classify_triads
 
 
 class CraterDatabase:
@@ -124,14 +123,11 @@ class CraterDatabase:
         """
         C_triads = np.array(list(map(lambda vertex: self._C_cat[vertex], crater_triads.T)))
 
-        A_i, A_j, A_k = map(lambda T, C: LA.inv(T).transpose((0, 2, 1)) @ C @ LA.inv(T), H_C_triads, C_triads)
+        A_i, A_j, A_k = map(project_conics, C_triads, H_C_triads)
         r_i, r_j, r_k = map(conic_center, (A_i, A_j, A_k))
 
-        cw_value = LA.det(np.moveaxis(np.array([[r_i[:, 0], r_i[:, 1], np.ones_like(r_i[:, 0])],
-                                                [r_j[:, 0], r_j[:, 1], np.ones_like(r_i[:, 0])],
-                                                [r_k[:, 0], r_k[:, 1], np.ones_like(r_i[:, 0])]]), -1, 0))
-        clockwise = cw_value < 0
-        line = cw_value == 0
+        clockwise, line, _ = classify_triads(np.array((r_i[:, 0], r_j[:, 0], r_k[:, 0])),
+                                             np.array((r_i[:, 1], r_j[:, 1], r_k[:, 1])))
 
         clockwise = clockwise[~line]
         crater_triads = crater_triads[~line]
@@ -141,7 +137,7 @@ class CraterDatabase:
         H_C_triads[[0, 1], np.argwhere(~clockwise)] = H_C_triads[[1, 0], np.argwhere(~clockwise)]
 
         C_triads = np.array(list(map(lambda vertex: self._C_cat[vertex], crater_triads.T)))
-        A_i, A_j, A_k = map(lambda T, C: LA.inv(T).transpose((0, 2, 1)) @ C @ LA.inv(T), H_C_triads, C_triads)
+        A_i, A_j, A_k = map(project_conics, C_triads, H_C_triads)
 
         invariants = CoplanarInvariants(crater_triads, A_i, A_j, A_k, normalize_det=True)
 
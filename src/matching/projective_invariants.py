@@ -1,9 +1,116 @@
+import math
+from functools import lru_cache
+
 import numpy as np
-import numpy.linalg as LA
+from numba import njit, prange
+
+from src.common.conics import conic_matrix, conic_center
+from src.matching.utils import classify_triads, enhanced_pattern_shifting_array, shift_nd
+
+_SQRT3 = math.sqrt(3.)
+_NEG3_SQRT3 = -3. * _SQRT3
+_HALF_SQRT3 = 0.5 * _SQRT3
+
+
+# Largest triad array kept in the EPS cache (~3 MB as int32, about 117 detections), which bounds the cache to ~50 MB
+_EPS_CACHE_MAX_TRIADS = 2 ** 18
+
+
+def _eps_triads(n_det):
+    """Enhanced Pattern Shifting triads for n_det detections. The order only depends on n_det, so read-only arrays
+    for small detection counts are cached; larger ones are O(n^3) in memory and built on demand.
+    """
+    if math.comb(n_det, 3) > _EPS_CACHE_MAX_TRIADS:
+        return enhanced_pattern_shifting_array(n_det)
+    return _cached_eps_triads(n_det)
+
+
+@lru_cache(maxsize=16)
+def _cached_eps_triads(n_det):
+    triads = enhanced_pattern_shifting_array(n_det)
+    triads.setflags(write=False)
+    return triads
+
+
+@njit(inline='always')
+def _load_3x3(m, scale):
+    return (scale * m[0, 0], scale * m[0, 1], scale * m[0, 2],
+            scale * m[1, 0], scale * m[1, 1], scale * m[1, 2],
+            scale * m[2, 0], scale * m[2, 1], scale * m[2, 2])
+
+
+@njit(inline='always')
+def _add_3x3(m1, m2, sign):
+    return (m1[0] + sign * m2[0], m1[1] + sign * m2[1], m1[2] + sign * m2[2],
+            m1[3] + sign * m2[3], m1[4] + sign * m2[4], m1[5] + sign * m2[5],
+            m1[6] + sign * m2[6], m1[7] + sign * m2[7], m1[8] + sign * m2[8])
+
+
+@njit(inline='always')
+def _adjugate_3x3(m):
+    a, b, c, d, e, f, g, h, i = m
+    return (e * i - f * h, c * h - b * i, b * f - c * e,
+            f * g - d * i, a * i - c * g, c * d - a * f,
+            d * h - e * g, b * g - a * h, a * e - b * d)
 
-from src.common.conics import matrix_adjugate, scale_det, conic_matrix, conic_center
-from src.matching.utils import np_swap_columns, is_colinear, is_clockwise, enhanced_pattern_shifting, \
-    shift_nd
+
+@njit(inline='always')
+def _determinant_3x3(m, adj):
+    return m[0] * adj[0] + m[1] * adj[3] + m[2] * adj[6]
+
+
+@njit(inline='always')
+def _trace_mul_3x3(m1, m2):
+    """tr(m1 @ m2) for row-major 3x3 tuples."""
+    return (m1[0] * m2[0] + m1[1] * m2[3] + m1[2] * m2[6] +
+            m1[3] * m2[1] + m1[4] * m2[4] + m1[5] * m2[7] +
+            m1[6] * m2[2] + m1[7] * m2[5] + m1[8] * m2[8])
+
+
+@njit(inline='always')
+def _nonsingular_3x3(m, eps):
+    """Scale-invariant singularity test, |det(m)| > eps * ||m||_F^3. With eps = 0 only exactly singular (or non-finite)
+    matrices fail."""
+    norm_sq = 0.
+    for v in m:
+        norm_sq += v * v
+    return abs(_determinant_3x3(m, _adjugate_3x3(m))) > eps * norm_sq * np.sqrt(norm_sq)
+
+
+@njit(parallel=True, cache=True)
+def _coplanar_invariants_kernel(A_i, A_j, A_k, normalize_det, eps, out, valid):
+    """Fills out (7xN) with I_ij, I_ji, I_ik, I_ki, I_jk, I_kj, I_ijk for every triad, using
+    tr(inv(A) @ B) = tr(adj(A) @ B) / det(A) on register-resident 3x3 tuples. Triads containing overlapping craters
+    (singular pairwise differences) are flagged False in valid and left uncomputed.
+    """
+    for n in prange(A_i.shape[0]):
+        M_i, M_j, M_k = _load_3x3(A_i[n], 1.), _load_3x3(A_j[n], 1.), _load_3x3(A_k[n], 1.)
+
+        valid[n] = (_nonsingular_3x3(_add_3x3(M_i, M_j, -1.), eps) and
+                    _nonsingular_3x3(_add_3x3(M_i, M_k, -1.), eps) and
+                    _nonsingular_3x3(_add_3x3(M_j, M_k, -1.), eps))
+        if not valid[n]:
+            continue
+
+        if normalize_det:
+            M_i = _load_3x3(A_i[n], np.cbrt(1. / _determinant_3x3(M_i, _adjugate_3x3(M_i))))
+            M_j = _load_3x3(A_j[n], np.cbrt(1. / _determinant_3x3(M_j, _adjugate_3x3(M_j))))
+            M_k = _load_3x3(A_k[n], np.cbrt(1. / _determinant_3x3(M_k, _adjugate_3x3(M_k))))
+
+        adj_i, adj_j, adj_k = _adjugate_3x3(M_i), _adjugate_3x3(M_j), _adjugate_3x3(M_k)
+        det_i, det_j, det_k = _determinant_3x3(M_i, adj_i), _determinant_3x3(M_j, adj_j), _determinant_3x3(M_k, adj_k)
+
+        out[0, n] = _trace_mul_3x3(adj_i, M_j) / det_i
+        out[1, n] = _trace_mul_3x3(adj_j, M_i) / det_j
+        out[2, n] = _trace_mul_3x3(adj_i, M_k) / det_i
+        out[3, n] = _trace_mul_3x3(adj_k, M_i) / det_k
+        out[4, n] = _trace_mul_3x3(adj_j, M_k) / det_j
+        out[5, n] = _trace_mul_3x3(adj_k, M_j) / det_k
+
+        adj_diff = _add_3x3(_adjugate_3x3(_add_3x3(M_j, M_k, 1.)), _adjugate_3x3(_add_3x3(M_j, M_k, -1.)), -1.)
+        out[6, n] = _trace_mul_3x3(adj_diff, M_i)
+
+    return out
 
 
 class PermutationInvariant:
@@ -16,14 +123,28 @@ class PermutationInvariant:
         return x + y + z
 
     @staticmethod
-    def F2(x, y, z):
-        return (2 * (x ** 3 + y ** 3 + z ** 3) + 12 * x * y * z - 3 * (
-                (x ** 2) * y + (y ** 2) * x + (y ** 2) * z + (z ** 2) * y + (z ** 2) * x + (x ** 2) * z)) / \
-               (x ** 2 + y ** 2 + z ** 2 - (x * y + y * z + z * x))
+    def _differences(x, y, z):
+        """Pairwise differences shared by F2 and F3, together with their common denominator
+        x^2 + y^2 + z^2 - (xy + yz + zx) = ((x-y)^2 + (y-z)^2 + (z-x)^2) / 2."""
+        d_xy, d_yz, d_zx = x - y, y - z, z - x
+        return d_xy, d_yz, d_zx, 0.5 * (d_xy ** 2 + d_yz ** 2 + d_zx ** 2)
 
     @staticmethod
-    def F3(x, y, z):
-        return (-3 * np.sqrt(3) * (x - y) * (y - z) * (z - x)) / (x ** 2 + y ** 2 + z ** 2 - (x * y + y * z + z * x))
+    def _F2(d_xy, d_yz, d_zx, denominator):
+        # 2(x^3 + y^3 + z^3) + 12xyz - 3(x^2y + ...) factors into (2x - y - z)(2y - z - x)(2z - x - y)
+        return (d_xy - d_zx) * (d_yz - d_xy) * (d_zx - d_yz) / denominator
+
+    @staticmethod
+    def _F3(d_xy, d_yz, d_zx, denominator):
+        return _NEG3_SQRT3 * d_xy * d_yz * d_zx / denominator
+
+    @classmethod
+    def F2(cls, x, y, z):
+        return cls._F2(*cls._differences(x, y, z))
+
+    @classmethod
+    def F3(cls, x, y, z):
+        return cls._F3(*cls._differences(x, y, z))
 
     @classmethod
     def F(cls, x, y, z):
@@ -43,7 +164,8 @@ class PermutationInvariant:
         ----------
         .. [1] Christian, J. A., Derksen, H., & Watkins, R. (2020). Lunar Crater Identification in Digital Images. https://arxiv.org/abs/2009.01228
         """
-        return np.array((cls.F1(x, y, z), cls.F2(x, y, z), cls.F3(x, y, z)))
+        differences = cls._differences(x, y, z)
+        return np.array((cls.F1(x, y, z), cls._F2(*differences), cls._F3(*differences)))
 
     @staticmethod
     def G1(x1, y1, z1, x2, y2, z2):
@@ -51,7 +173,7 @@ class PermutationInvariant:
 
     @staticmethod
     def G2(x1, y1, z1, x2, y2, z2):
-        return (np.sqrt(3) / 2.) * ((x1 * z2 + y1 * x2 + z1 * y2) - (x1 * y2 + y1 * z2 + z1 * x2))
+        return _HALF_SQRT3 * ((x1 * z2 + y1 * x2 + z1 * y2) - (x1 * y2 + y1 * z2 + z1 * x2))
 
     # TODO: Fix cyclic permutation invariant G
     @classmethod
@@ -79,13 +201,14 @@ class PermutationInvariant:
         .. [1] Christian, J. A., Derksen, H., & Watkins, R. (2020). Lunar Crater Identification in Digital Images. https://arxiv.org/abs/2009.01228
 
         """
-        return cls.G(x1, y1, z1, x2, y2, z2) / np.sqrt(np.sqrt(
-            (((x1 - y1) ** 2 + (y1 - z1) ** 2 + (z1 - x1) ** 2) * ((x2 - y2) ** 2 + (y2 - z2) ** 2 + (z2 - x2) ** 2))))
+        inv_norm = (((x1 - y1) ** 2 + (y1 - z1) ** 2 + (z1 - x1) ** 2) *
+                    ((x2 - y2) ** 2 + (y2 - z2) ** 2 + (z2 - x2) ** 2)) ** -0.25
+        return cls.G(x1, y1, z1, x2, y2, z2) * inv_norm
 
 
 # TODO: Refactor
 class CoplanarInvariants:
-    def __init__(self, crater_triads, A_i, A_j, A_k, normalize_det=True):
+    def __init__(self, crater_triads, A_i, A_j, A_k, normalize_det=True, overlap_eps=0.):
         """Generates projective invariants [1] assuming craters are coplanar. Input is an array of crater matrices
         such as those generated using L{conic_matrix}.
 
@@ -101,31 +224,25 @@ class CoplanarInvariants:
             Crater representation third crater in triad
         normalize_det : bool
             Set to True to normalize matrices to achieve det(A) = 1
+        overlap_eps : float
+            Triads in which the difference of two crater matrices has |det(A_i - A_j)| <= overlap_eps * ||A_i -
+            A_j||_F^3 are considered overlapping and discarded. The default of 0 only rejects exactly singular
+            differences (e.g. coincident craters); projected crater conics are legitimately ill-conditioned, with
+            relative determinants down to ~1e-16, so any positive value should be chosen with care.
 
         References
         ----------
         .. [1] Christian, J. A., Derksen, H., & Watkins, R. (2020). Lunar Crater Identification in Digital Images. https://arxiv.org/abs/2009.01228
         """
 
-        self.crater_triads = crater_triads
-        overlapped_craters = ~np.logical_and.reduce((
-            np.isfinite(LA.cond(A_i - A_j)),
-            np.isfinite(LA.cond(A_i - A_k)),
-            np.isfinite(LA.cond(A_j - A_k))
-        ))
-        A_i, A_j, A_k = map(lambda craters_: craters_[~overlapped_craters], (A_i, A_j, A_k))
-        self.crater_triads = self.crater_triads[~overlapped_craters]
-
-        if normalize_det:
-            A_i, A_j, A_k = map(scale_det, (A_i, A_j, A_k))
+        A_i, A_j, A_k = map(lambda craters_: np.ascontiguousarray(craters_, dtype=np.float64).reshape(-1, 3, 3),
+                            (A_i, A_j, A_k))
 
-        self.I_ij, self.I_ji = np.trace(LA.inv(A_i) @ A_j, axis1=-2, axis2=-1), np.trace(LA.inv(A_j) @ A_i, axis1=-2,
-                                                                                         axis2=-1)
-        self.I_ik, self.I_ki = np.trace(LA.inv(A_i) @ A_k, axis1=-2, axis2=-1), np.trace(LA.inv(A_k) @ A_i, axis1=-2,
-                                                                                         axis2=-1)
-        self.I_jk, self.I_kj = np.trace(LA.inv(A_j) @ A_k, axis1=-2, axis2=-1), np.trace(LA.inv(A_k) @ A_j, axis1=-2,
-                                                                                         axis2=-1)
-        self.I_ijk = np.trace((matrix_adjugate(A_j + A_k) - matrix_adjugate(A_j - A_k)) @ A_i, axis1=-2, axis2=-1)
+        valid = np.empty(len(A_i), np.bool_)
+        invariants = _coplanar_invariants_kernel(A_i, A_j, A_k, normalize_det, overlap_eps, np.empty((7, len(A_i))),
+                                                 valid)[:, valid]
+        self.crater_triads = crater_triads[valid]
+        self.I_ij, self.I_ji, self.I_ik, self.I_ki, self.I_jk, self.I_kj, self.I_ijk = invariants
 
     @classmethod
     def from_detection_conics(cls,
@@ -134,30 +251,21 @@ class CoplanarInvariants:
                               ):
 
         if crater_triads is None:
-            n_det = len(A_craters)
-            n_comb = int((n_det * (n_det - 1) * (n_det - 2)) // 6)
+            crater_triads = _eps_triads(len(A_craters))
 
-            crater_triads = np.zeros((n_comb, 3), int)
-            for it, (i, j, k) in enumerate(enhanced_pattern_shifting(n_det)):
-                crater_triads[it] = np.array([i, j, k])
+        return cls._from_triads(A_craters, conic_center(A_craters), crater_triads)
 
-        r_pix = conic_center(A_craters)
+    @classmethod
+    def _from_triads(cls, A_craters, r_pix, crater_triads):
         x_pix = r_pix[:, 0]
         y_pix = r_pix[:, 1]
 
-        x_triads, y_triads = x_pix[crater_triads].T, y_pix[crater_triads].T
-        clockwise = is_clockwise(x_triads, y_triads)
-
-        crater_triads_cw = crater_triads.copy()
-        crater_triads_cw[~clockwise] = np_swap_columns(crater_triads[~clockwise])
-        x_triads[:, ~clockwise] = np_swap_columns(x_triads.T[~clockwise]).T
-        y_triads[:, ~clockwise] = np_swap_columns(y_triads.T[~clockwise]).T
-
-        crater_triads_cw = crater_triads_cw[~is_colinear(x_triads, y_triads)]
-
-        A_i, A_j, A_k = np.array(list(map(lambda vertex: A_craters[vertex], crater_triads_cw.T)))
+        # Swapping two vertices flips the sign of the orientation, so colinearity can be taken from the input order
+        clockwise, colinear, _ = classify_triads(x_pix[crater_triads].T, y_pix[crater_triads].T)
+        perm = np.where(clockwise[:, None], np.array([0, 1, 2]), np.array([1, 0, 2]))
+        crater_triads_cw = np.take_along_axis(crater_triads, perm, axis=1)[~colinear]
 
-        return cls(crater_triads_cw, A_i, A_j, A_k)
+        return cls(crater_triads_cw, *(A_craters[vertex] for vertex in crater_triads_cw.T))
 
     @classmethod
     def match_generator(cls,
@@ -219,78 +327,33 @@ class CoplanarInvariants:
             raise ValueError("No detections provided! Use either parameterized ellipse values or conics as input.")
 
         n_det = len(A_craters)
-        if batch_size == 1:
-            for it, (i, j, k) in enumerate(enhanced_pattern_shifting(n_det)):
-
-                crater_triad = np.array([i, j, k])
-                r_pix = conic_center(A_craters[crater_triad])
-                x_pix = r_pix[:, 0]
-                y_pix = r_pix[:, 1]
-
-                if not is_clockwise(x_pix, y_pix):
-                    crater_triad[[0, 1]] = crater_triad[[1, 0]]
-
-                A_i, A_j, A_k = np.array(list(map(lambda vertex: A_craters[vertex], crater_triad)))
-                out = cls(crater_triad[None, :], A_i, A_j, A_k)
-                key = out.get_pattern()
+        r_pix = conic_center(A_craters)
 
-                if sort_ij:
-                    ij_idx = np.abs(key[:3]).argmin()
-                    order = np.roll(np.arange(3), -ij_idx)
-                    order_full = np.append(np.concatenate((order, order + 3)), -1)
+        if batch_size == 1:
+            out = cls._from_triads(A_craters, r_pix, enhanced_pattern_shifting_array(n_det, max_iter + 1))
+            key = out.get_pattern().reshape(-1, 7)
 
-                    yield crater_triad[order], key[order_full]
-                else:
-                    yield crater_triad, key
+            if sort_ij:
+                crater_triads, key = cls._sort_ij(out.crater_triads, key)
+            else:
+                crater_triads = out.crater_triads
 
-                if it >= max_iter:
-                    break
+            yield from zip(crater_triads, key)
 
         elif batch_size > 1:
-            n_comb = int((n_det * (n_det - 1) * (n_det - 2)) // 6)
+            n_comb = math.comb(n_det, 3)
 
             if batch_size > n_comb:
                 batch_size = n_comb
 
-            crater_triads = np.zeros((batch_size, 3), int)
-            eps_generator = enhanced_pattern_shifting(n_det)
-            for it in range(n_comb // batch_size):
-                for index, (i, j, k) in enumerate(eps_generator):
-                    crater_triads[index] = np.array([i, j, k])
-                    if index >= batch_size - 1:
-                        break
-
-                r_pix = conic_center(A_craters)
-                x_pix = r_pix[:, 0]
-                y_pix = r_pix[:, 1]
-
-                x_triads, y_triads = x_pix[crater_triads].T, y_pix[crater_triads].T
-                clockwise = is_clockwise(x_triads, y_triads)
-
-                crater_triads_cw = crater_triads.copy()
-                crater_triads_cw[~clockwise] = np_swap_columns(crater_triads[~clockwise])
-                x_triads[:, ~clockwise] = np_swap_columns(x_triads.T[~clockwise]).T
-                y_triads[:, ~clockwise] = np_swap_columns(y_triads.T[~clockwise]).T
-
-                crater_triads_cw = crater_triads_cw[~is_colinear(x_triads, y_triads)]
-
-                A_i, A_j, A_k = np.array(list(map(lambda vertex: A_craters[vertex], crater_triads_cw.T)))
-                out = cls(crater_triads_cw, A_i, A_j, A_k)
+            n_batches = min(n_comb // batch_size, max_iter + 1)
+            eps_triads = enhanced_pattern_shifting_array(n_det, n_batches * batch_size)
+            for it in range(n_batches):
+                out = cls._from_triads(A_craters, r_pix, eps_triads[it * batch_size:(it + 1) * batch_size])
                 key = out.get_pattern()
 
                 if sort_ij:
-                    ij_idx = np.abs(key[..., :3]).argmin(1)
-                    key = np.concatenate((
-                        shift_nd(key[..., :3], -ij_idx),
-                        shift_nd(key[..., 3:6], -ij_idx),
-                        key[:, [-1]]
-                    ),
-                        axis=-1
-                    )
-                    crater_triads_sorted = shift_nd(out.crater_triads, -ij_idx)
-
-                    yield crater_triads_sorted, key
-
+                    yield cls._sort_ij(out.crater_triads, key)
                 else:
                     yield out.crater_triads, key
 
@@ -299,6 +362,19 @@ class CoplanarInvariants:
         else:
             raise ValueError("batch_size must be 1 or more!")
 
+    @staticmethod
+    def _sort_ij(crater_triads, key):
+        """Cyclically shifts triads and their features such that I_ij has the lowest absolute value."""
+        ij_idx = np.abs(key[..., :3]).argmin(1)
+        key = np.concatenate((
+            shift_nd(key[..., :3], -ij_idx),
+            shift_nd(key[..., 3:6], -ij_idx),
+            key[:, [-1]]
+        ),
+            axis=-1
+        )
+        return shift_nd(crater_triads, -ij_idx), key
+
     def get_pattern(self, permutation_invariant=False):
         """Get matching pattern using either permutation invariant features (eq. 134 from [1]) or raw projective
         invariants (p. 61 from [1]).
@@ -319,23 +395,17 @@ class CoplanarInvariants:
         """
 
         if permutation_invariant:
-            out = np.column_stack((
-                PermutationInvariant.F(self.I_ij, self.I_jk, self.I_ki).T,
-                PermutationInvariant.F1(self.I_ji, self.I_kj, self.I_ik),
-                PermutationInvariant.G_tilde(self.I_ij, self.I_jk, self.I_ki, self.I_ji, self.I_kj, self.I_ik).T,
-                self.I_ijk
-            )).T
+            out = np.empty((7, len(self)))
+            out[:3] = PermutationInvariant.F(self.I_ij, self.I_jk, self.I_ki)
+            out[3] = PermutationInvariant.F1(self.I_ji, self.I_kj, self.I_ik)
+            out[4:6] = PermutationInvariant.G_tilde(self.I_ij, self.I_jk, self.I_ki, self.I_ji, self.I_kj, self.I_ik)
+            out[6] = self.I_ijk
 
         else:
-            out = np.column_stack((
-                self.I_ij,
-                self.I_jk,
-                self.I_ki,
-                self.I_ji,
-                self.I_kj,
-                self.I_ik,
-                self.I_ijk,
-            ))
+            out = np.empty((len(self), 7))
+            for column, invariant in enumerate((self.I_ij, self.I_jk, self.I_ki, self.I_ji, self.I_kj, self.I_ik,
+                                                self.I_ijk)):
+                out[:, column] = invariant
 
         if len(self) == 1:
             return out.squeeze()
@@ -1,7 +1,6 @@
 import networkx as nx
 import numpy as np
-import numpy.linalg as LA
-from numba import njit
+from numba import njit, prange
 from typing import Tuple
 
 
@@ -15,9 +14,10 @@ def np_swap_columns(arr):
 
 
 def cw_or_ccw(x_triads, y_triads):
-    return LA.det(np.moveaxis(np.array([[x_triads[0], y_triads[0], np.ones_like(x_triads[0])],
-                                        [x_triads[1], y_triads[1], np.ones_like(x_triads[0])],
-                                        [x_triads[2], y_triads[2], np.ones_like(x_triads[0])]]), -1, 0))
+    """Twice the signed area of the triangles (x0, y0), (x1, y1), (x2, y2), equal to the determinant of their
+    homogeneous coordinates. Negative for clockwise, zero for colinear points."""
+    return (x_triads[1] - x_triads[0]) * (y_triads[2] - y_triads[0]) - \
+           (x_triads[2] - x_triads[0]) * (y_triads[1] - y_triads[0])
 
 
 def is_colinear(x_triads_, y_triads_):
@@ -44,6 +44,36 @@ def all_clockwise(x_triads_, y_triads_):
     return np.logical_and.reduce(is_clockwise(x_triads_, y_triads_))
 
 
+@njit(parallel=True, cache=True)
+def classify_triads(x_triads, y_triads):
+    """Classifies the orientation of every triad in a single pass over the signed areas, instead of calling
+    is_clockwise, is_colinear and all_clockwise separately.
+
+    Parameters
+    ----------
+    x_triads, y_triads : np.ndarray
+        (3xN) array of 2D coordinates for triangles in a plane
+
+    Returns
+    -------
+    clockwise, colinear : np.ndarray
+        Boolean masks for clockwise and colinear triads
+    all_clockwise : bool
+        Whether every triad is clockwise
+    """
+    n = x_triads.shape[1]
+    clockwise = np.empty(n, np.bool_)
+    colinear = np.empty(n, np.bool_)
+
+    for ii in prange(n):
+        area = (x_triads[1, ii] - x_triads[0, ii]) * (y_triads[2, ii] - y_triads[0, ii]) - \
+               (x_triads[2, ii] - x_triads[0, ii]) * (y_triads[1, ii] - y_triads[0, ii])
+        clockwise[ii] = area < 0
+        colinear[ii] = area == 0
+
+    return clockwise, colinear, clockwise.all()
+
+
 def cyclic_permutations(it, step=1):
     """Returns cyclic permutations for iterable.
 
@@ -72,10 +102,29 @@ def cyclic_permutations(it, step=1):
         yield p
 
 
+def get_triangles(G):
+    """Return all triangles (3-cliques) in an undirected graph G by intersecting the higher-indexed neighbourhoods of
+    every edge. Triangles are listed in the same order as nx.enumerate_all_cliques would produce them.
+    """
+    index = {u: i for i, u in enumerate(G)}
+    nbrs = {u: sorted((v for v in G[u] if index[v] > index[u]), key=index.__getitem__) for u in G}
+    nbrs_set = {u: set(v) for u, v in nbrs.items()}
+
+    triangles = []
+    for u in G:
+        for it, v in enumerate(nbrs[u]):
+            nbrs_v = nbrs_set[v]
+            triangles.extend([u, v, w] for w in nbrs[u][it + 1:] if w in nbrs_v)
+    return triangles
+
+
 # https://stackoverflow.com/questions/1705824/finding-cycle-of-3-nodes-or-triangles-in-a-graph
 def get_cliques_by_length(G, length_clique):
     """ Return the list of all cliques in an undirected graph G with length
     equal to length_clique. """
+    if length_clique == 3:
+        return get_triangles(G)
+
     cliques = []
     for c in nx.enumerate_all_cliques(G):
         if len(c) <= length_clique:
@@ -135,9 +184,56 @@ def enhanced_pattern_shifting(n, start_n=0) -> Tuple[int, int, int]:
                     index += 1
 
 
+@njit(cache=True)
+def enhanced_pattern_shifting_array(n, max_n=-1):
+    """Returns crater triads in Enhanced Pattern Shifting order [1] as a single array, written directly into a
+    preallocated buffer instead of being yielded one by one.
+
+    Parameters
+    ----------
+    n : int
+        Number of detected instances.
+    max_n : int
+        Only build the first max_n triads, defaults to -1 (all triads).
+
+    Returns
+    -------
+    np.ndarray
+        (min(n_comb, max_n) x 3) int32 array of triad indices i, j, k
+
+    References
+    ----------
+    .. [1] Arnas, D., Fialho, M. A. A., & Mortari, D. (2017). Fast and robust kernel generators for star trackers. Acta Astronautica, 134 (August 2016), 291–302. https://doi.org/10.1016/j.actaastro.2017.02.016
+    """
+    if n < 3:
+        raise ValueError("Number of detections must be equal or higher than 3!")
+
+    n_comb = (n * (n - 1) * (n - 2)) // 6
+    if 0 <= max_n < n_comb:
+        n_comb = max_n
+
+    out = np.empty((n_comb, 3), np.int32)
+    if n_comb == 0:
+        return out
+
+    index = 0
+    for dj in range(1, n - 1):
+        for dk in range(1, n - dj):
+            for ii in range(3):
+                for i in range(ii, n - dj - dk, 3):
+                    out[index, 0] = i
+                    out[index, 1] = i + dj
+                    out[index, 2] = i + dj + dk
+                    index += 1
+                    if index == n_comb:
+                        return out
+
+    return out
+
+
 @njit
 def eps_array(n, start_n=0, batch_size=int(1e4)):
-    n_comb = int((n * (n - 1) * (n - 2)) // 6)
+    n_comb = (n * (n - 1) * (n - 2)) // 6
 
     if batch_size is None or n_comb <= batch_size:
         out = np.empty((n_comb, 3), np.uint32)
@@ -154,9 +250,11 @@ def eps_array(n, start_n=0, batch_size=int(1e4)):
     return out
 
 
-@njit
+@njit(cache=True)
 def shift_nd(arr: np.ndarray, shift: np.ndarray):
-    out = np.zeros_like(arr, arr.dtype)
+    out = np.empty_like(arr)
+    m = arr.shape[1]
     for ii in range(arr.shape[0]):
-        out[ii] = np.roll(arr[ii], shift[ii])
+        for jj in range(m):
+            out[ii, jj] = arr[ii, (jj - shift[ii]) % m]
     return out
@@ -31,6 +31,10 @@ def get_parser():
                         help='Device to train model on (`cpu` or `cuda`)')
     parser.add_argument('--ellipse_loss_metric', type=str, default='gaussian-angle',
                         choices=['gaussian-angle', 'kullback-leibler'], help='Ellipse loss metric for EllipseRoIHeads.')
+    parser.add_argument('--amp', action='store_true',
+                        help='Train using automatic mixed precision (CUDA only).')
+    parser.add_argument('--compile', action='store_true',
+                        help='Compile the model forward pass with torch.compile (requires PyTorch 2.0+).')
 
     return parser
 
@@ -52,5 +56,7 @@ if __name__ == "__main__":
                 num_workers=args.num_workers,
                 momentum=args.momentum,
                 weight_decay=args.weight_decay,
-                device=args.device
+                device=args.device,
+                amp=args.amp,
+                compile_model=args.compile
                 )